@@ -6,41 +6,48 @@ module Main where
 
 -- import Debug.Trace
 
-import qualified Algorithms.NaturalSort as NaturalSort
-
-import Brick ((<+>), (<=>))
 import qualified Brick as B
 import qualified Brick.Widgets.List as B
 import qualified Brick.Widgets.Border as B
-import qualified Brick.Widgets.Center as B
+import qualified Brick.BChan as B
 
 import qualified Graphics.Vty as V
 
 import Control.Monad
 import Control.Monad.IO.Class
 import Control.Exception
+import Control.Concurrent
+import Control.Concurrent.STM
 import Control.Lens
 
 import System.Environment
+import System.IO
 import System.Process
 import System.FilePath
 import System.Directory hiding (isSymbolicLink)
 import System.PosixCompat
 
-import Data.Foldable
 import Data.Char
 import Data.Maybe
 import Data.List
 import Data.Bool
 import Data.Functor
-import qualified Data.Text as Text
+import Data.IORef
+import qualified Data.Map.Strict as Map
 import qualified Data.Vector as Vector
 import qualified Data.ByteString as BS
+import qualified Data.ByteString.Unsafe as BS
+import qualified Data.ByteString.Char8 as BC
+import qualified Data.ByteString.Builder as BB
+
+import Foreign.Marshal.Alloc (allocaBytes)
+import Foreign.Ptr (castPtr)
 
 import qualified Options.Applicative as Opt
 
 data Options = Options
   { optionEditor :: String
+  , optionTrustMtime :: Bool
   , optionDir1 :: FilePath
   , optionDir2 :: FilePath
   } deriving (Show)
@@ -55,6 +62,10 @@ optionsParser = Opt.info (Opt.helper <*> prog) desc where
        <> Opt.showDefault
        <> Opt.help "Program used to edit two files"
         )
+    <*> Opt.switch
+        ( Opt.long "trust-mtime"
+       <> Opt.help "Treat files with equal size and modification time as matching"
+        )
     <*> Opt.strArgument (Opt.metavar "DIR1")
     <*> Opt.strArgument (Opt.metavar "DIR2")
   desc = Opt.fullDesc <> Opt.progDesc "diff two directories"
@@ -75,95 +86,387 @@ data DiffStatus
   | Unknown
   | Different
   | OneSided
+  | Pending
   deriving (Eq, Show)
 
 data DiffInfo = DiffInfo
-  { diffName :: String
-  , diffStatus :: DiffStatus
-  , diffLeft :: FileType
-  , diffRight :: FileType
+  { diffName :: !String
+  , diffStatus :: !DiffStatus
+  , diffLeft :: !FileType
+  , diffRight :: !FileType
   } deriving (Show)
 
 parentDiffInfo :: DiffInfo
 parentDiffInfo = DiffInfo ".." Matching Directory Directory
 
+fileTypes :: [(FileMode, FileType)]
+fileTypes =
+  [ (regularFileMode      , RegularFile)
+  , (directoryMode        , Directory)
+  , (symbolicLinkMode     , Symlink)
+  , (blockSpecialMode     , BlockDevice)
+  , (characterSpecialMode , CharDevice)
+  , (namedPipeMode        , NamedPipe)
+  , (socketMode           , Socket) ]
+
 fileType :: FileStatus -> FileType
-fileType file
-  | isRegularFile file     = RegularFile
-  | isDirectory file       = Directory
-  | isSymbolicLink file    = Symlink
-  | isBlockDevice file     = BlockDevice
-  | isCharacterDevice file = CharDevice
-  | isNamedPipe file       = NamedPipe
-  | isSocket file          = Socket
-  | otherwise              = BlockDevice
-
-diffFolders :: FilePath -> FilePath -> IO [DiffInfo]
-diffFolders x y = sequence =<< diffFolders' x y
-
-diffFolders' :: FilePath -> FilePath -> IO [IO DiffInfo]
-diffFolders' x y = liftM2 diffFiles
-  (map (x </>) . sortOn NaturalSort.sortKey <$> listDirectory x)
-  (map (y </>) . sortOn NaturalSort.sortKey <$> listDirectory y)
-
-diffFiles :: [FilePath] -> [FilePath] -> [IO DiffInfo]
-diffFiles xs ys = case (xs, ys) of
-  (xs, []) -> map left xs
-  ([], ys) -> map right xs
-  (x:xs, y:ys) -> case NaturalSort.compare (takeFileName x) (takeFileName y) of
-    LT -> left x : diffFiles xs (y:ys)
-    GT -> right y : diffFiles (x:xs) ys
-    EQ -> case compare (takeFileName x) (takeFileName y) of
-      LT -> left x : diffFiles xs (y:ys)
-      GT -> right y : diffFiles (x:xs) ys
-      EQ -> diffFile x y : diffFiles xs ys
-  where left x = getFileStatus x <&> \t ->
-          DiffInfo (takeFileName x) OneSided (fileType t) Missing
-        right x = getFileStatus x <&> \t ->
-          DiffInfo (takeFileName x) OneSided Missing (fileType t)
-
-diffFile :: FilePath -> FilePath -> IO DiffInfo
-diffFile x y = do
-  xs <- getFileStatus x
-  ys <- getFileStatus y
-  let status s = DiffInfo (takeFileName x) s (fileType xs) (fileType ys)
-  case (fileType xs, fileType ys) of
-    _ | (deviceID xs, fileID xs) == (deviceID ys, fileID ys) ->
+fileType file = fromMaybe BlockDevice
+  (lookup (fileMode file `intersectFileModes` fileTypeModes) fileTypes)
+
+data NaturalChunk
+  = NaturalNumber Integer
+  | NaturalText String
+  deriving (Eq, Ord)
+
+-- | Sort key comparing digit runs numerically and text case-insensitively;
+-- names differing only in case keep their listing order.
+naturalKey :: String -> [NaturalChunk]
+naturalKey [] = []
+naturalKey str@(c:_)
+  | isDigit c = let (n, rest) = span isDigit str in NaturalNumber (read n) : naturalKey rest
+  | otherwise = let (t, rest) = break isDigit str in NaturalText (map toLower t) : naturalKey rest
+
+data Entry = Entry
+  { entryName :: String
+  , entryPath :: FilePath
+  , entryStatus :: FileStatus
+  , entryType :: FileType
+  }
+
+statEntry :: FilePath -> String -> IO Entry
+statEntry dir name = getSymbolicLinkStatus path <&> \st ->
+  Entry name path st (fileType st)
+  where path = dir </> name
+
+followEntry :: Entry -> IO Entry
+followEntry entry = getFileStatus (entryPath entry) <&> \st ->
+  entry{entryStatus = st, entryType = fileType st}
+
+sameFile :: FileStatus -> FileStatus -> Bool
+sameFile x y = deviceID x == deviceID y && fileID x == fileID y
+
+listEntries :: FilePath -> IO [Entry]
+listEntries dir = mapM (statEntry dir) =<< listDirectory dir
+
+newtype Workers = Workers (TVar Int)
+
+newWorkers :: Int -> IO Workers
+newWorkers n = Workers <$> newTVarIO n
+
+-- | Claim a free worker slot, optionally waiting for one to be released.
+claimWorker :: Bool -> Workers -> IO Bool
+claimWorker wait (Workers free) = atomically $ do
+  n <- readTVar free
+  if n > 0 then writeTVar free (n - 1) >> return True
+    else if wait then retry else return False
+
+-- | Run an action on a claimed worker slot, releasing it when done.
+forkWorker :: Workers -> IO a -> IO (IO a)
+forkWorker (Workers free) action = do
+  result <- newEmptyMVar
+  let release = atomically (modifyTVar' free (+ 1))
+  void (forkFinally action (\r -> release >> putMVar result r))
+  return (readMVar result >>= either throwIO return)
+
+-- | Run an action on a spare worker thread if there is one, otherwise
+-- leave it to be run inline when its result is demanded.
+spawn :: Workers -> IO a -> IO (IO a)
+spawn workers action = claimWorker False workers
+  >>= bool (return action) (forkWorker workers action)
+
+type Signature = (Integer, Integer, Integer, Integer)
+
+signature :: FileStatus -> Signature
+signature st =
+  ( toInteger (deviceID st), toInteger (fileID st), toInteger (fileSize st)
+  , truncate (modificationTimeHiRes st * 1000000000) )
+
+-- | The device and inode numbers of two directories compared side by side.
+type DirectoryPair = (Integer, Integer, Integer, Integer)
+
+directoryPair :: FileStatus -> FileStatus -> DirectoryPair
+directoryPair x y =
+  ( toInteger (deviceID x), toInteger (fileID x)
+  , toInteger (deviceID y), toInteger (fileID y) )
+
+data DiffEnv = DiffEnv
+  { envWorkers :: Workers
+  , envCache :: IORef Cache
+  , envCancelled :: IO Bool
+  , envTrustMtime :: Bool
+  , envAncestors :: [DirectoryPair]
+  }
+
+data Cancelled = Cancelled deriving (Show)
+
+instance Exception Cancelled
+
+cacheLimit :: Int
+cacheLimit = 65536
+
+-- | Comparison results keyed by the signatures of both files, each with
+-- the tick it was last used at so the least recently used can be evicted.
+data Cache = Cache
+  { cacheTick :: !Int
+  , cacheEntries :: !(Map.Map (Signature, Signature) (Int, DiffStatus))
+  , cacheRecent :: !(Map.Map Int (Signature, Signature))
+  }
+
+emptyCache :: Cache
+emptyCache = Cache 0 Map.empty Map.empty
+
+lookupCache :: (Signature, Signature) -> Cache -> Maybe DiffStatus
+lookupCache key = fmap snd . Map.lookup key . cacheEntries
+
+-- | Record a result as the most recently used, evicting the least recently
+-- used one once there are more than 'cacheLimit'.
+insertCache :: (Signature, Signature) -> DiffStatus -> Cache -> Cache
+insertCache key status Cache{..} = evict (Cache (cacheTick + 1) entries recent)
+  where
+    (old, entries) = Map.insertLookupWithKey (\_ new _ -> new) key (cacheTick, status) cacheEntries
+    recent = Map.insert cacheTick key (maybe id (Map.delete . fst) old cacheRecent)
+    evict cache@(Cache tick es rs)
+      | Map.size es <= cacheLimit = cache
+      | otherwise = let ((_, k), rs') = Map.deleteFindMin rs in Cache tick (Map.delete k es) rs'
+
+cacheFile :: IO FilePath
+cacheFile = getXdgDirectory XdgCache ("ddiff" </> "comparisons")
+
+loadCache :: IO Cache
+loadCache = handle (\(_ :: IOException) -> return emptyCache) $ do
+  contents <- BC.readFile =<< cacheFile
+  return $! foldl' (flip (uncurry insertCache)) emptyCache
+    (mapMaybe (parse . BC.words) (BC.lines contents))
+  where
+    parse [] = Nothing
+    parse (tag : fields) = do
+      status <- lookup tag [("m", Matching), ("d", Different)]
+      [a, b, c, d, e, f, g, h] <- mapM integer fields
+      return (((a, b, c, d), (e, f, g, h)), status)
+    integer field = case BC.readInteger field of
+      Just (n, rest) | BS.null rest -> Just n
+      _ -> Nothing
+
+-- | Write the cache to a temporary file and rename it over the old one, so
+-- a crash or another session never leaves a partial file behind.
+saveCache :: Cache -> IO ()
+saveCache Cache{..} = handle (\(_ :: IOException) -> return ()) $ do
+  path <- cacheFile
+  let dir = takeDirectory path
+  createDirectoryIfMissing True dir
+  (temp, out) <- openBinaryTempFile dir (takeFileName path)
+  (BB.hPutBuilder out contents >> hClose out)
+    `onException` (hClose out >> removeFile temp)
+  renameFile temp path
+  where
+    contents = foldMap format (mapMaybe entry (Map.elems cacheRecent))
+    entry key = (,) key . snd <$> Map.lookup key cacheEntries
+    format (((a, b, c, d), (e, f, g, h)), status) = BB.string7 (tag status)
+      <> foldMap ((BB.char7 ' ' <>) . BB.integerDec) [a, b, c, d, e, f, g, h]
+      <> BB.char7 '\n'
+    tag Matching = "m"
+    tag _ = "d"
+
+cachedStatus :: DiffEnv -> (Signature, Signature) -> IO DiffStatus -> IO DiffStatus
+cachedStatus DiffEnv{..} key action = do
+  hit <- lookupCache key <$> readIORef envCache
+  s <- maybe action return hit
+  when (s /= Unknown) $ atomicModifyIORef' envCache $ \cache ->
+    (insertCache key s cache, ())
+  return s
+
+alignFolders :: FilePath -> FilePath -> IO [Aligned]
+alignFolders x y = liftM2 alignEntries (listEntries x) (listEntries y)
+
+-- | Subtrees are compared on worker threads once a directory has more
+-- than 'parallelThreshold' subdirectories in common.
+parallelThreshold :: Int
+parallelThreshold = 4
+
+diffFolders' :: DiffEnv -> FilePath -> FilePath -> IO [IO DiffInfo]
+diffFolders' env x y = do
+  cancelled <- envCancelled env
+  when cancelled (throwIO Cancelled)
+  diffAll env =<< alignFolders x y
+
+-- | One-sided entries settle a subtree without touching the pairs; files
+-- are compared before directories, which are the expensive part.
+diffAll :: DiffEnv -> [Aligned] -> IO [IO DiffInfo]
+diffAll env aligned = case filter (not . paired) aligned of
+  a : _ -> return [diffAligned env a]
+  [] -> do
+    let parallel = length (filter bothDirectories aligned) > parallelThreshold
+        run a | parallel && bothDirectories a = spawn (envWorkers env) (diffAligned env a)
+              | otherwise = return (diffAligned env a)
+    mapM run (sortOn bothDirectories aligned)
+  where bothDirectories (Both x y) = entryType x == Directory && entryType y == Directory
+        bothDirectories _ = False
+        paired (Both _ _) = True
+        paired _ = False
+
+data Aligned
+  = LeftOnly Entry
+  | RightOnly Entry
+  | Both Entry Entry
+
+alignEntries :: [Entry] -> [Entry] -> [Aligned]
+alignEntries xs ys = Map.elems $
+  Map.unionWith merge (byName LeftOnly xs) (byName RightOnly ys)
+  where byName side es = Map.fromList [ (entryName e, side e) | e <- es ]
+        merge (LeftOnly x) (RightOnly y) = Both x y
+        merge x _ = x
+
+alignedInfo :: Aligned -> DiffInfo
+alignedInfo (LeftOnly x) = DiffInfo (entryName x) OneSided (entryType x) Missing
+alignedInfo (RightOnly y) = DiffInfo (entryName y) OneSided Missing (entryType y)
+alignedInfo (Both x y) = DiffInfo (entryName x) Pending (entryType x) (entryType y)
+
+diffAligned :: DiffEnv -> Aligned -> IO DiffInfo
+diffAligned env (Both x y) = diffFile env x y
+diffAligned _ aligned = return (alignedInfo aligned)
+
+diffFile :: DiffEnv -> Entry -> Entry -> IO DiffInfo
+diffFile env x@(Entry xn xp xs xt) y@(Entry _ yp ys yt) =
+  case (xt, yt) of
+    _ | sameFile xs ys ->
       return (status Matching)
-    (Symlink, _) -> getSymbolicLinkTarget x >>= \x' ->
-      diffFile x' y <&> \info -> info{diffName=x, diffLeft=Symlink}
-    (_, Symlink) -> getSymbolicLinkTarget y >>= \y' ->
-      diffFile x y' <&> \info -> info{diffRight=Symlink}
-    (xt, yt) | xt /= yt ->
+    (Symlink, Symlink) -> sameTarget >>= bool followLeft (return (status Matching))
+    (Symlink, _) -> followLeft
+    (_, Symlink) -> followRight
+    _ | xt /= yt ->
       return (status Different)
-    (Directory, Directory) ->
-      let match True [] = return Unknown
-          match False [] = return Matching
-          match unknown (x:xs) = x >>= \d -> case diffStatus d of
-            Matching -> match unknown xs
-            Unknown -> match True xs
-            _ -> return Different
-       in fmap status . match False =<< diffFolders' x y
+    (Directory, Directory)
+      | identity `elem` envAncestors env -> return (status Unknown)
+      | otherwise -> do
+        stop <- newIORef False
+        let env' = env
+              { envCancelled = liftM2 (||) (envCancelled env) (readIORef stop)
+              , envAncestors = identity : envAncestors env }
+            match True [] = return Unknown
+            match False [] = return Matching
+            match unknown (x:xs) = x >>= \d -> case diffStatus d of
+              Matching -> match unknown xs
+              Unknown -> match True xs
+              _ -> writeIORef stop True >> return Different
+        fmap status . match False =<< diffFolders' env' xp yp
     (RegularFile, RegularFile)
       | fileSize xs /= fileSize ys ->
         return (status Different)
-      | otherwise ->
-        let handler (_ :: IOException) = return (status Unknown)
-            action = liftM2 (==) (BS.readFile x) (BS.readFile y) <&> 
-              bool (status Different) (status Matching)
-         in action `catch` handler
+      | envTrustMtime env && modificationTimeHiRes xs == modificationTimeHiRes ys ->
+        return (status Matching)
+      | otherwise -> status <$>
+        cachedStatus env (signature xs, signature ys)
+          (compareFiles (envCancelled env) (toInteger (fileSize xs)) xp yp)
     _ -> return (status Unknown)
+  where status s = DiffInfo xn s xt yt
+        identity = directoryPair xs ys
+        sameTarget = liftM2 (==) (readSymbolicLink xp) (readSymbolicLink yp)
+          `catch` \(_ :: IOException) -> return False
+        followLeft = followed x (\x' -> diffFile env x' y)
+          <&> \info -> info{diffLeft=Symlink}
+        followRight = followed y (diffFile env x)
+          <&> \info -> info{diffRight=Symlink}
+        followed entry cont = (followEntry entry >>= cont)
+          `catch` \(_ :: IOException) -> return (status Unknown)
+
+-- | Bounds on what a scan reads ahead; far below 'cacheLimit', so the
+-- prefetched results cannot evict each other.
+prefetchFiles :: Int
+prefetchFiles = 1024
+
+prefetchBytes :: Integer
+prefetchBytes = 268435456
+
+-- | Compare the same-sized regular file pairs directly inside the given
+-- directory pairs, so the comparison cache is warm when one is entered.
+prefetchFolders :: DiffEnv -> [(FilePath, FilePath)] -> IO ()
+prefetchFolders env dirs = do
+  aligned <- concat <$> forM dirs (\(x, y) ->
+    alignFolders x y `catch` \(_ :: IOException) -> return [])
+  let files = [ (a, b) | Both a b <- aligned
+              , entryType a == RegularFile, entryType b == RegularFile
+              , fileSize (entryStatus a) == fileSize (entryStatus b) ]
+      total = scanl1 (+) [ toInteger (fileSize (entryStatus a)) | (a, _) <- files ]
+  forM_ (take prefetchFiles (map snd (takeWhile ((<= prefetchBytes) . fst) (zip total files))))
+    $ \(a, b) -> do
+      cancelled <- envCancelled env
+      when cancelled (throwIO Cancelled)
+      void (diffFile env a b)
+
+sampleSize :: Int
+sampleSize = 4096
+
+-- | Files larger than this have their first and last 'sampleSize' bytes
+-- checked before being read in full.
+sampleThreshold :: Integer
+sampleThreshold = 65536
+
+compareFiles :: IO Bool -> Integer -> FilePath -> FilePath -> IO DiffStatus
+compareFiles cancelled size x y = action `catch` handler where
+  handler (_ :: IOException) = return Unknown
+  action = withBinaryFile x ReadMode $ \hx -> withBinaryFile y ReadMode $ \hy -> do
+    same <- if size <= sampleThreshold then return True
+      else liftM2 (==) (sample hx) (sample hy)
+    bool Different Matching <$> if same then sameContents cancelled hx hy else return False
+  sample h = do
+    start <- BS.hGet h sampleSize
+    hSeek h SeekFromEnd (negate (toInteger sampleSize))
+    end <- BS.hGet h sampleSize
+    hSeek h AbsoluteSeek 0
+    return (start, end)
+
+compareChunk :: Int
+compareChunk = 1048576
+
+-- | Compare two handles chunk by chunk, giving up with 'Cancelled' once
+-- the scan they belong to has been abandoned.
+sameContents :: IO Bool -> Handle -> Handle -> IO Bool
+sameContents cancelled x y =
+  allocaBytes compareChunk $ \bx -> allocaBytes compareChunk $ \by ->
+    let loop = do
+          stop <- cancelled
+          when stop (throwIO Cancelled)
+          nx <- hGetBuf x bx compareChunk
+          ny <- hGetBuf y by compareChunk
+          cx <- BS.unsafePackCStringLen (castPtr bx, nx)
+          cy <- BS.unsafePackCStringLen (castPtr by, ny)
+          if cx /= cy then return False
+            else if nx == 0 then return True
+            else loop
+     in loop
 
 data AppState = AppState
   { stateOpts :: Options
   , stateBase1 :: FilePath
   , stateBase2 :: FilePath
   , stateCwd :: [String]
+  , stateEnv :: DiffEnv
+  , stateChan :: B.BChan DiffEvent
+  , stateGen :: Int
+  , stateStop :: IO ()
+  , stateTally :: Tally
   , stateDiff :: B.List String DiffInfo
-  } deriving (Show)
+  }
+
+-- | Rows finished by a scan wait in a shared buffer; an event is posted
+-- only when the buffer was empty, and its handler takes the whole buffer.
+data DiffEvent = DiffResults Int (TVar [(Int, DiffInfo)])
+
+-- | The number of rows still pending and the number not matching.
+data Tally = Tally !Int !Int
+
+tallyRow :: Int -> DiffInfo -> Tally -> Tally
+tallyRow n DiffInfo{..} (Tally pending different) = Tally
+  (pending + n * fromEnum (diffStatus == Pending))
+  (different + n * fromEnum (diffStatus /= Matching))
+
+tallyStatus :: Tally -> DiffStatus
+tallyStatus (Tally 0 0) = Matching
+tallyStatus (Tally 0 _) = Different
+tallyStatus _ = Pending
 
 type Name = String
-type App = B.App AppState () Name
+type App = B.App AppState DiffEvent Name
 
 app :: App
 app = B.App
@@ -177,27 +480,49 @@ app = B.App
 appChooseCursor :: AppState -> [B.CursorLocation Name] -> Maybe (B.CursorLocation Name)
 appChooseCursor s xs = Nothing
 
-appHandleEvent :: AppState -> B.BrickEvent Name e -> B.EventM Name (B.Next AppState)
+appHandleEvent :: AppState -> B.BrickEvent Name DiffEvent -> B.EventM Name (B.Next AppState)
 appHandleEvent s event@(B.VtyEvent eventV@(V.EvKey key mod)) = case (key, mod) of
-  (V.KChar 'q', []) -> B.halt s
-  (V.KEsc, []) -> B.halt s
+  (V.KChar 'q', []) -> quit s
+  (V.KEsc, []) -> quit s
+  (V.KChar 'r', []) -> refresh s
   (V.KEnter, []) -> enterEntry s
   (V.KRight, []) -> enterEntry s
   (V.KLeft, []) -> enterDirectory ".." s
   _ -> do
     diff' <- B.handleListEvent eventV (stateDiff s)
     B.continue s{stateDiff = diff'}
+appHandleEvent s (B.AppEvent (DiffResults gen ready))
+  | gen == stateGen s = do
+      rows <- liftIO (atomically (swapTVar ready []))
+      let elems = stateDiff s ^. B.listElementsL
+          retally t (i, d) = tallyRow 1 d (tallyRow (-1) (elems Vector.! i) t)
+      B.continue s{ stateDiff = B.listElementsL .~ (elems Vector.// rows) $ stateDiff s
+                  , stateTally = foldl' retally (stateTally s) rows }
 appHandleEvent s _ = B.continue s
 
+quit :: AppState -> B.EventM Name (B.Next AppState)
+quit state = liftIO (stateStop state) >> B.halt state
+
+refresh :: AppState -> B.EventM Name (B.Next AppState)
+refresh state@AppState{..} = do
+  liftIO (writeIORef (envCache stateEnv) emptyCache)
+  B.continue =<< liftIO (updateDiff state)
+
 enterEntry :: AppState -> B.EventM Name (B.Next AppState)
 enterEntry state@AppState{..} = maybe (enterDirectory ".." state)
   (enterEntry . snd) (B.listSelectedElement stateDiff)
   where
-    enterEntry (DiffInfo name status left right) = case (left, right) of
-      (Directory, Directory) -> enterDirectory name state
-      (Missing, Directory) -> B.continue state
-      (Directory, Missing) -> B.continue state
-      _ -> enterFile name state
+    enterEntry (DiffInfo name status left right) = do
+      let (dir1, dir2) = currentDirs state
+      left' <- resolve (dir1 </> name) left
+      right' <- resolve (dir2 </> name) right
+      case (left', right') of
+        (Directory, Directory) -> enterDirectory name state
+        (Missing, Directory) -> B.continue state
+        (Directory, Missing) -> B.continue state
+        _ -> enterFile name state
+    resolve path Symlink = liftIO (doesDirectoryExist path <&> bool Symlink Directory)
+    resolve _ ftype = return ftype
 
 currentDirs :: AppState -> (FilePath, FilePath)
 currentDirs AppState{..} = (stateBase1 </> cwd', stateBase2 </> cwd')
@@ -205,9 +530,44 @@ currentDirs AppState{..} = (stateBase1 </> cwd', stateBase2 </> cwd')
 
 updateDiff :: AppState -> IO AppState
 updateDiff state@AppState{..} = do
-  ds <- liftIO (uncurry diffFolders (currentDirs state))
-  let elems = Vector.fromList (parentDiffInfo : ds)
-  return state{ stateDiff = B.listElementsL .~ elems $ stateDiff }
+  let (dir1, dir2) = currentDirs state
+  aligned <- sortOn (naturalKey . diffName . alignedInfo) <$> alignFolders dir1 dir2
+  here <- liftM2 directoryPair (getFileStatus dir1) (getFileStatus dir2)
+  let gen = stateGen + 1
+      elems = Vector.fromList (parentDiffInfo : map alignedInfo aligned)
+  stateStop
+  cancelled <- newIORef False
+  let env = stateEnv{envCancelled = readIORef cancelled, envAncestors = [here]}
+  ready <- newTVarIO []
+  worker <- forkIO (diffInBackground env stateChan gen ready aligned)
+  return state{ stateEnv = env, stateGen = gen
+              , stateStop = writeIORef cancelled True >> killThread worker
+              , stateTally = foldr (tallyRow 1) (Tally 0 0) elems
+              , stateDiff = B.listElementsL .~ elems $ stateDiff }
+
+-- | Compare each pair on a worker, posting its row as soon as it is done,
+-- then warm the cache inside the directories that turned out different.
+diffInBackground :: DiffEnv -> B.BChan DiffEvent -> Int
+                 -> TVar [(Int, DiffInfo)] -> [Aligned] -> IO ()
+diffInBackground env@DiffEnv{..} chan gen ready aligned =
+  handle (\Cancelled -> return ()) $ do
+    pending <- forM pairs $ \(i, a) -> mask $ \restore ->
+      claimWorker True envWorkers >> forkWorker envWorkers (restore (post i a))
+    results <- sequence pending
+    prefetchFolders env [ (entryPath x, entryPath y)
+                        | (Both x y, DiffInfo _ Different Directory Directory)
+                            <- zip (map snd pairs) results ]
+  where pairs = [ (i, a) | (i, a@(Both _ _)) <- zip [1..] aligned ]
+        post i a = do
+          info <- recover a (diffAligned env a)
+          wake <- atomically $ do
+            rows <- readTVar ready
+            writeTVar ready ((i, info) : rows)
+            return (null rows)
+          when wake (B.writeBChan chan (DiffResults gen ready))
+          return info
+        recover a action = action `catch` \(_ :: IOException) ->
+          return (alignedInfo a){diffStatus = Unknown}
 
 enterDirectory :: String -> AppState -> B.EventM Name (B.Next AppState)
 enterDirectory ".." state@AppState{stateCwd=[]} = B.continue state
@@ -217,6 +577,7 @@ enterDirectory name state@AppState{..} =
 
 enterFile :: String -> AppState -> B.EventM Name (B.Next AppState)
 enterFile name state = B.suspendAndResume $ do
+  stateStop state
   let (dir1, dir2) = currentDirs state
       cmd:args = words (optionEditor (stateOpts state))
   cmd' <- case cmd of
@@ -229,12 +590,16 @@ appStartEvent :: AppState -> B.EventM Name AppState
 appStartEvent = liftIO . updateDiff
 
 appAttrMap :: AppState -> B.AttrMap
-appAttrMap s = B.attrMap V.defAttr
+appAttrMap = const diffAttrMap
+
+diffAttrMap :: B.AttrMap
+diffAttrMap = B.attrMap V.defAttr
   [ ("status-matching"      , V.defAttr)
   , ("status-missing"       , B.fg V.brightRed)
   , ("status-onesided"      , B.fg V.brightGreen)
   , ("status-different"     , B.fg V.brightYellow)
   , ("status-unknown"       , B.fg V.brightBlue)
+  , ("status-pending"       , B.fg V.brightBlack)
   , ("filetype-regularfile" , V.defAttr)
   , ("filetype-directory"   , B.fg V.brightBlue)
   , ("filetype-symlink"     , B.fg V.brightCyan)
@@ -249,16 +614,14 @@ appDraw state@AppState{..} =
   [ B.joinBorders $ B.vBox [ B.hBox [left, B.vBorder, right], B.hBorder, help ] ] where
     left = drawDiff stateBase1 diffLeft state
     right = drawDiff stateBase2 diffRight state
-    help = B.strWrap "q/esc: quit. up/down: select. enter: edit/open"
+    help = B.strWrap "q/esc: quit. up/down: select. enter: edit/open. r: refresh"
 
 drawDiff :: String -> (DiffInfo -> FileType) -> AppState -> B.Widget Name
 drawDiff base ftype state@AppState{..} = B.padRight B.Max $ B.vBox
-  [ drawLine ftype False (DiffInfo base status Directory Directory)
+  [ drawLine ftype False (DiffInfo base (tallyStatus stateTally) Directory Directory)
   , B.hBorder
   , B.renderList (drawLine ftype) True (B.listNameL .~ base $ stateDiff) ]
   where
-    status = if allOf (B.listElementsL . folded . to diffStatus) (== Matching) stateDiff
-      then Matching else Different
     upDir = isNothing (B.listSelected stateDiff)
 
 drawLine :: (DiffInfo -> FileType) -> Bool -> DiffInfo -> B.Widget Name
@@ -273,26 +636,50 @@ drawSelect = bool (B.str " ")
 
 drawStatus :: DiffStatus -> FileType -> B.Widget Name
 drawStatus status ftype = B.withAttr
-  (B.attrName ("status-" ++ name)) (B.str [statusChar status ftype])
-  where name = if ftype == Missing then "missing" else map toLower (show status)
+  (statusAttr status ftype) (B.str [statusChar status ftype])
 
 drawName :: String -> FileType -> B.Widget Name
 drawName _ Missing = B.emptyWidget
-drawName name ftype = B.withAttr
-  (B.attrName ("filetype-" ++ map toLower (show ftype)))
-  (B.str name)
+drawName name ftype = B.withAttr (fileTypeAttr ftype) (B.str name)
+
+statusAttr :: DiffStatus -> FileType -> B.AttrName
+statusAttr _ Missing   = "status-missing"
+statusAttr Matching  _ = "status-matching"
+statusAttr Unknown   _ = "status-unknown"
+statusAttr Different _ = "status-different"
+statusAttr OneSided  _ = "status-onesided"
+statusAttr Pending   _ = "status-pending"
+
+fileTypeAttr :: FileType -> B.AttrName
+fileTypeAttr Missing     = "filetype-missing"
+fileTypeAttr RegularFile = "filetype-regularfile"
+fileTypeAttr Directory   = "filetype-directory"
+fileTypeAttr Symlink     = "filetype-symlink"
+fileTypeAttr BlockDevice = "filetype-blockdevice"
+fileTypeAttr CharDevice  = "filetype-chardevice"
+fileTypeAttr NamedPipe   = "filetype-namedpipe"
+fileTypeAttr Socket      = "filetype-socket"
 
 statusChar :: DiffStatus -> FileType -> Char
 statusChar Matching  _ = ' '
 statusChar Different _ = '~'
 statusChar Unknown   _ = '?'
+statusChar Pending   _ = '.'
 statusChar OneSided Missing = '-'
 statusChar OneSided _ = '+'
 
 main :: IO ()
 main = do
   opts@Options{..} <- Opt.execParser optionsParser
-  let initialState = AppState opts optionDir1 optionDir2 []
+  cache <- newIORef =<< loadCache
+  env <- DiffEnv <$> (newWorkers . max 16 =<< getNumCapabilities)
+    <*> pure cache <*> pure (return False) <*> pure optionTrustMtime
+    <*> pure []
+  chan <- B.newBChan 16
+  let initialState = AppState opts optionDir1 optionDir2 [] env chan 0 (return ()) (Tally 0 0)
         (B.list "diff" (Vector.fromList []) 1)
-  void (B.defaultMain app initialState)
+      buildVty = V.mkVty V.defaultConfig
+  initialVty <- buildVty
+  void (B.customMain initialVty buildVty (Just chan) app initialState)
+  saveCache =<< readIORef cache
 